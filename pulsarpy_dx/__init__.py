@@ -1,5 +1,8 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 import sys
 
 
@@ -9,22 +12,49 @@ LOG_DIR = "PulsarpyDx"
 if not os.path.exists(LOG_DIR):
     os.mkdir(LOG_DIR)
 
+#: The maximum number of worker threads at each level of concurrency of an import: the DNAnexus
+#: projects imported at once, and, within each project, both the libraries processed at once and the
+#: SequencingResults posted at once. The levels nest, so with the default of 8 there can be roughly
+#: 8 + 2 * 8 ** 2 threads and up to 8 ** 2 requests to the Pulsar server in flight at once. Can be
+#: tuned via the environment variable PULSARPYDX_MAX_WORKERS, i.e. to stay within rate limits.
+MAX_WORKERS = int(os.environ.get("PULSARPYDX_MAX_WORKERS", 8))
+
+#: The maximum number of DNAnexus API requests in flight at once across all worker threads. Since
+#: projects and the libraries within each project are both imported concurrently, this bounds the
+#: load put on DNAnexus. Can be tuned via the environment variable PULSARPYDX_MAX_DX_REQUESTS.
+MAX_DX_REQUESTS = int(os.environ.get("PULSARPYDX_MAX_DX_REQUESTS", 32))
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s:%(name)s:%(levelname)s:   %(message)s')
 chandler = logging.StreamHandler(sys.stdout)
 chandler.setLevel(logging.DEBUG)
 chandler.setFormatter(formatter)
-logger.addHandler(chandler)
 
-# Add debug file handler
-fhandler = logging.FileHandler(filename=os.path.join(LOG_DIR,"log_debug_dx-seq-import.txt"),mode="a")
+# Add debug file handler. delay=True means the file isn't opened until the first record is written.
+fhandler = logging.FileHandler(filename=os.path.join(LOG_DIR,"log_debug_dx-seq-import.txt"),mode="a", delay=True)
 fhandler.setLevel(logging.DEBUG)
 fhandler.setFormatter(formatter)
-logger.addHandler(fhandler)
 
 # Add error file handler
-err_h = logging.FileHandler(filename=os.path.join(LOG_DIR,"log_error_dx-seq-import.txt") ,mode="a")
+err_h = logging.FileHandler(filename=os.path.join(LOG_DIR,"log_error_dx-seq-import.txt") ,mode="a", delay=True)
 err_h.setLevel(logging.ERROR)
 err_h.setFormatter(formatter)
-logger.addHandler(err_h)
+
+# The logger only enqueues records; a background thread writes them out to the handlers above, so
+# that the (possibly many concurrent) callers never block on disk I/O.
+log_queue = queue.Queue(-1)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, chandler, fhandler, err_h, respect_handler_level=True)
+log_listener.start()
+# Flush any records still in the queue when the interpreter exits.
+atexit.register(log_listener.stop)
+
+def flush_logs():
+    """
+    Blocks until all queued log records have been written out to the log files, i.e. before the log
+    files are uploaded elsewhere. Logging continues to work afterwards.
+    """
+    # stop() drains the queue before returning; start a new listener thread for any later records.
+    log_listener.stop()
+    log_listener.start()
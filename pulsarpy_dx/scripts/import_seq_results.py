@@ -15,22 +15,25 @@ See wiki documentation in the pulsar_lims GitHub repo at https://github.com/nath
 
 If the --log-s3 flag is set, then the log files will be uploaded to S3 in the bucket specified by the
 environment variable PULSARPYDX_S3. The log files will be stored in this bucket by timestamp.
+
+Projects, and the libraries within each project, are imported concurrently. The number of worker
+threads defaults to 8 and can be set via the environment variable PULSARPYDX_MAX_WORKERS. It applies
+at each level: to the projects imported at once, and to the libraries processed and the
+SequencingResults posted at once within each project. So up to PULSARPYDX_MAX_WORKERS squared
+requests can be sent to Pulsar at once. The number of DNAnexus API requests in flight at once
+defaults to 32 and can be set via the environment variable PULSARPYDX_MAX_DX_REQUESTS.
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import datetime
-import time
-import logging
 import os
 
 import boto3
 import dxpy
 
-import pulsarpy.models
 import pulsarpy.utils
-from pulsarpy.elasticsearch_utils import MultipleHitsException
-import scgpm_seqresults_dnanexus.dnanexus_utils as du
-from pulsarpy_dx import logger, LOG_DIR
+from pulsarpy_dx import logger, flush_logs, LOG_DIR, MAX_WORKERS
 import pulsarpy_dx.utils as utils
 
 
@@ -61,45 +64,68 @@ def main():
     projects = projects["results"]
     # projects is a list of dicts (was a generator)
     num_projects = len(projects)
-    logger.debug("Found {} projects.".format(num_projects))
+    logger.debug("Found %d projects.", num_projects)
     if projects:
         for i in range(num_projects):
-            logger.debug("{}. {}".format(str(i + 1), projects[i]["id"]))
+            logger.debug("%d. %s", i + 1, projects[i]["id"])
     else: 
         return
 
-    for i in projects:
-        proj_id = i["id"]
-        print(proj_id)
-        du.share_with_org(project_ids=[proj_id], org=ENCODE_ORG, access_level="CONTRIBUTE")
-        try:
-            utils.import_dx_project(proj_id)
-        except utils.MissingSequencingRequest:
-            logger.error("No SequencingRequest for DNAnexus project {}.".format(proj_id))
-        except Exception as e:
-            # Send email with error details to Admin
-            body = "Error importing sequencing results for DNAnexus project {}.\n\n".format(proj_id)
-            body += e.__class__.__name__ + ": " + str(e)
-            logger.error(body)
-            form = {
-                "subject": "Error in import_seq_results.py",
-                "text": body,
-                "to": pulsarpy.DEFAULT_TO,
-            }
-            res = pulsarpy.utils.send_mail(form=form, from_name="import_seq_results")
-        finally:
-            if log_s3:
-                s3 = boto3.resource('s3')
-                bucket = s3.Bucket(os.environ["PULSARPYDX_S3"])
-                # Add subfolder for the present day
-                upload_folder = str(datetime.date.today()) + "/"
-                bucket.put_object(Key=upload_folder)  # put_object() is idempotent
-                today_logs = os.path.join(LOG_DIR)
-                for logfile in os.listdir(today_logs):
-                    filepath = os.path.join(today_logs, logfile)
-                    key = os.path.join(upload_folder, logfile)
-                    bucket.upload_file(Key=key, Filename=filepath) 
-               
+    proj_ids = [i["id"] for i in projects]
+    # Each import is dominated by blocking DNAnexus and Pulsar HTTP round-trips, so the projects
+    # are imported concurrently.
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            list(executor.map(import_project, proj_ids))
+    finally:
+        if log_s3:
+            # Records are written out by a background thread, so make sure the log files are
+            # complete before uploading them.
+            flush_logs()
+            upload_logs_to_s3()
+
+def import_project(proj_id):
+    """
+    Shares the given DNAnexus project with the ENCODE org and imports its sequencing results into
+    Pulsar. Any error is logged and emailed to the admin rather than raised, so that a failure in
+    one project doesn't abort the import of the others.
+
+    Args:
+        proj_id: `str`. The ID of a DNAnexus project.
+    """
+    print(proj_id)
+    try:
+        utils.share_with_org(proj_id, org=ENCODE_ORG, access_level="CONTRIBUTE")
+        utils.import_dx_project(proj_id)
+    except utils.MissingSequencingRequest:
+        logger.error("No SequencingRequest for DNAnexus project %s.", proj_id)
+    except Exception as e:
+        # Send email with error details to Admin
+        body = "Error importing sequencing results for DNAnexus project {}.\n\n".format(proj_id)
+        body += e.__class__.__name__ + ": " + str(e)
+        logger.error(body)
+        form = {
+            "subject": "Error in import_seq_results.py",
+            "text": body,
+            "to": pulsarpy.DEFAULT_TO,
+        }
+        res = pulsarpy.utils.send_mail(form=form, from_name="import_seq_results")
+
+def upload_logs_to_s3():
+    """
+    Uploads the log files to the S3 bucket specified by the environment variable PULSARPYDX_S3.
+    The log files are stored in a subfolder named after the present day.
+    """
+    s3 = boto3.resource('s3')
+    bucket = s3.Bucket(os.environ["PULSARPYDX_S3"])
+    # Add subfolder for the present day
+    upload_folder = str(datetime.date.today()) + "/"
+    bucket.put_object(Key=upload_folder)  # put_object() is idempotent
+    today_logs = os.path.join(LOG_DIR)
+    for logfile in os.listdir(today_logs):
+        filepath = os.path.join(today_logs, logfile)
+        key = os.path.join(upload_folder, logfile)
+        bucket.upload_file(Key=key, Filename=filepath) 
 
 
 def get_read_stats(barcode_stats, read_num):
@@ -7,12 +7,24 @@
 #nathankw@stanford.edu
 ###
 
-import pdb
+from concurrent.futures import ThreadPoolExecutor
+import functools
+from io import StringIO
+import itertools
+import re
+import threading
 
-from pulsarpy_dx import logger
+import cachetools
+import dxpy
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from pulsarpy_dx import logger, MAX_WORKERS, MAX_DX_REQUESTS
 from pulsarpy import models
 from pulsarpy.elasticsearch_utils import MultipleHitsException
 import scgpm_seqresults_dnanexus.dnanexus_utils as du 
+import scgpm_seqresults_dnanexus.picard_tools as picard
 
 class BarcodeNotSet(Exception):
     """
@@ -25,6 +37,136 @@ class MissingSequencingRequest(Exception):
     """
 
 
+class _PooledRequests:
+    """
+    Stands in for the `requests` module within `pulsarpy.models`, which calls the module-level
+    functions `requests.get()`, `requests.post()`, etc. Each of those opens a new connection (and TLS
+    handshake) per call. Here, those calls go through a `requests.Session` instead so that
+    connections to the Pulsar server are kept alive and reused. Any other attribute (i.e.
+    `requests.codes`) is looked up on the `requests` module.
+
+    `requests.Session` isn't guaranteed to be thread safe, and its cookie jar would otherwise be
+    shared by all threads, so each thread gets its own session. All of the sessions mount the same
+    `HTTPAdapter`, whose connection pool is thread safe, so connections are still reused across
+    threads.
+    """
+    def __init__(self, adapter):
+        self.adapter = adapter
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        """
+        The `requests.Session` of the calling thread, created on first use.
+        """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("https://", self.adapter)
+            session.mount("http://", self.adapter)
+            self._local.session = session
+        return session
+
+    def __getattr__(self, name):
+        if name in ("get", "post", "put", "patch", "delete", "head"):
+            return getattr(self.session, name)
+        return getattr(requests, name)
+
+def _install_pulsar_session():
+    """
+    Makes `pulsarpy.models` send its HTTP requests through pooled, keep-alive `requests.Session`s,
+    one per thread. Failed connections are retried with backoff. Retry doesn't apply to POST or
+    PATCH requests, which aren't idempotent.
+    """
+    # Projects and the libraries within each project are imported concurrently, so there can be up
+    # to MAX_WORKERS ** 2 requests to the Pulsar server in flight at once. Size the pool so that each
+    # of them can keep its connection rather than having it discarded and re-established.
+    pool_maxsize = max(32, MAX_WORKERS * MAX_WORKERS)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=Retry(total=3, backoff_factor=0.3))
+    models.requests = _PooledRequests(adapter)
+
+_install_pulsar_session()
+
+#: Bounds the number of concurrent DNAnexus API requests made by all threads.
+_DX_SEMAPHORE = threading.BoundedSemaphore(MAX_DX_REQUESTS)
+
+def _dx_call(func, *args, **kwargs):
+    """
+    Calls the given function, which makes DNAnexus API requests, once a slot is available under
+    `pulsarpy_dx.MAX_DX_REQUESTS`.
+    """
+    with _DX_SEMAPHORE:
+        return func(*args, **kwargs)
+
+#: Cache of Pulsar records keyed by (model class, record ID), shared by all threads, so that a record
+#: referenced several times during an import is only fetched once. Since the same instance is handed
+#: out to every caller, a patch() through any of them updates the cached record as well. Entries expire
+#: so that records which change on the server during a long-running import are eventually re-fetched.
+_RECORD_CACHE = cachetools.TTLCache(maxsize=1024, ttl=300)
+_RECORD_CACHE_LOCK = threading.Lock()
+
+def _get_record(model_cls, uid):
+    """
+    Returns an instance of the given `pulsarpy.models.Model` subclass for the given record ID,
+    fetching the record from Pulsar only if it isn't already in the record cache.
+
+    Args:
+        model_cls: A `pulsarpy.models.Model` subclass, i.e. `pulsarpy.models.Library`.
+        uid: The record ID, or any other identifier accepted by `pulsarpy.models.Model()`.
+    Returns:
+        `pulsarpy.models.Model` subclass instance.
+    """
+    key = (model_cls, uid)
+    with _RECORD_CACHE_LOCK:
+        rec = _RECORD_CACHE.get(key)
+    if rec is None:
+        # Fetch outside of the lock so that other threads aren't blocked on the HTTP request.
+        rec = model_cls(uid)
+        with _RECORD_CACHE_LOCK:
+            _RECORD_CACHE[key] = rec
+    return rec
+
+def clear_cache():
+    """
+    Empties all of the caches of Pulsar records and DNAnexus projects kept by this module. Meant for
+    long-running processes that import over a longer period of time than the records should be
+    trusted for, and for tests.
+    """
+    with _RECORD_CACHE_LOCK:
+        _RECORD_CACHE.clear()
+    with _SREQ_CACHE_LOCK:
+        _SREQ_CACHE.clear()
+    with _PE_CHECKED_LOCK:
+        _PE_CHECKED.clear()
+    get_dxres.cache_clear()
+    _dnanexus_provider_id.cache_clear()
+
+@functools.lru_cache(maxsize=256)
+def get_dxres(dx_project_id):
+    """
+    Returns the `scgpm_seqresults_dnanexus.dnanexus_utils.du.DxSeqResults()` instance for the given
+    DNAnexus project. Instantiation makes several DNAnexus API calls (i.e. to describe the project
+    and fetch its properties), so the instance is memoized and shared by all callers.
+
+    Args:
+        dx_project_id: `str`. The project ID of a DNAnexus project, i.e. FPg8yJQ900P4ZgzxFZbgJZY2.
+    Returns:
+        `scgpm_seqresults_dnanexus.dnanexus_utils.du.DxSeqResults()` instance.
+    """
+    return _dx_call(du.DxSeqResults, dx_project_id=dx_project_id)
+
+def share_with_org(dx_project_id, org, access_level="CONTRIBUTE"):
+    """
+    Shares the given DNAnexus project with a DNAnexus org, as a DNAnexus API call bounded by
+    `pulsarpy_dx.MAX_DX_REQUESTS` like the others made during an import.
+
+    Args:
+        dx_project_id: `str`. The project ID of a DNAnexus project, i.e. FPg8yJQ900P4ZgzxFZbgJZY2.
+        org: `str`. The ID of the DNAnexus org, i.e. org-snyder_encode.
+        access_level: `str`. The permission level to give the org's members on the project.
+    """
+    _dx_call(du.share_with_org, project_ids=[dx_project_id], org=org, access_level=access_level)
+
 def get_or_create_srun_by_ids(sreq_id, dx_project_id):
     """
     A wrapper over get_or_create_srun() below that simplifies the parameters to use IDs instead of
@@ -36,8 +178,8 @@ def get_or_create_srun_by_ids(sreq_id, dx_project_id):
     Returns:
         `pulsarpy.models.SequencingRun` instance.
     """
-    sreq = models.SequencingRequest(sreq_id)
-    dxres = du.DxSeqResults(dx_project_id=dx_project_id)
+    sreq = _get_record(models.SequencingRequest, sreq_id)
+    dxres = get_dxres(dx_project_id)
     return get_or_create_srun(sreq, dxres)
     
 def get_or_create_srun(sreq, dxres):
@@ -61,24 +203,90 @@ def get_or_create_srun(sreq, dxres):
     Returns:
         `pulsarpy.models.SequencingRun` instance.
     """
-    dx_proj_name = dxres.dx_project_name.strip().lower()
+    dx_proj_name = dxres.dx_project_name.strip()
+    # casefold() rather than lower() for a correct case-insensitive comparison of any Unicode name.
+    target = dx_proj_name.casefold()
     srun_ids = sreq.sequencing_run_ids
     if srun_ids:
-        for i in srun_ids:
-            srun = models.SequencingRun(i)
-            # Check by name, case-insensitive.
-            if srun.name.strip().lower() == dx_proj_name:
-                return srun
-            # Also check by DataStorage
-            elif srun.data_storage_id:
-                ds = models.DataStorage(srun.data_storage_id)
-                if ds.project_identifier == dxres.dx_project_id:
-                    return srun
+        # Rather than fetching each SequencingRun (and its DataStorage) one at a time, let
+        # Elasticsearch do the filtering and return only the matching SequencingRuns.
+        # Check by name, case-insensitive. The match_phrase query is case-insensitive, but can also
+        # match names that merely contain the DNAnexus project name, hence the exact comparison.
+        hits = search_sruns(sreq_id=sreq.id, name=dx_proj_name)
+        name_map = {(h.get("name") or "").strip().casefold(): h for h in hits}
+        hit = name_map.get(target)
+        if not hit:
+            # Also check by DataStorage. Several DataStorages can have the project's ID (i.e. one
+            # created by hand and another by an import), so check the DataStorage of each of the
+            # SequencingRequest's SequencingRuns rather than looking up a single DataStorage.
+            hits = search_sruns(sreq_id=sreq.id, size=len(srun_ids))
+            ds_ids = {h["data_storage_id"] for h in hits if h.get("data_storage_id")}
+            matching_ds_ids = filter_project_data_storages(ds_ids, dxres.dx_project_id)
+            hit = next((h for h in hits if h.get("data_storage_id") in matching_ds_ids), None)
+        if hit:
+            return _get_record(models.SequencingRun, hit["id"])
     # Create SequencingRun
     srun_json = create_srun(sreq, dxres)
-    srun = models.SequencingRun(srun_json["id"])
+    # Cache the new record too, as later lookups of it are likely within the same import.
+    srun = _get_record(models.SequencingRun, srun_json["id"])
     return srun
 
+def search_sruns(sreq_id, name=None, data_storage_id=None, size=10):
+    """
+    Searches the SequencingRun records of a SequencingRequest in Elasticsearch with a single query.
+    Only the fields needed to identify a SequencingRun are returned.
+
+    Args:
+        sreq_id: `int`. A Pulsar SequencingRequest record ID.
+        name: `str`. If set, restricts the hits to SequencingRuns whose name matches this phrase
+            (case-insensitive).
+        data_storage_id: `int`. If set, restricts the hits to SequencingRuns linked to this DataStorage.
+        size: `int`. The maximum number of hits to return.
+    Returns:
+        `list` of `dict`. Each contains the id, name, and data_storage_id of a SequencingRun.
+    """
+    filters = [{"term": {"sequencing_request_id": sreq_id}}]
+    if data_storage_id:
+        filters.append({"term": {"data_storage_id": data_storage_id}})
+    query = {"bool": {"filter": filters}}
+    if name:
+        query["bool"]["must"] = {"match_phrase": {"name": name}}
+    result = models.SequencingRun.ES.ES.search(
+        index=models.SequencingRun.ES_INDEX_NAME,
+        body={
+            "size": size,
+            "_source": ["id", "name", "data_storage_id"],
+            "query": query
+        }
+    )
+    return [h["_source"] for h in result["hits"]["hits"]]
+
+def filter_project_data_storages(ds_ids, project_identifier):
+    """
+    Finds which of the given DataStorage records belong to the given DNAnexus project, using a
+    single Elasticsearch query.
+
+    Args:
+        ds_ids: iterable of `int`. DataStorage record IDs.
+        project_identifier: `str`. The project ID of a DNAnexus project.
+    Returns:
+        `set` of `int`. The subset of `ds_ids` whose project_identifier attribute is equal to
+            `project_identifier`.
+    """
+    ds_ids = list(ds_ids)
+    if not ds_ids:
+        return set()
+    result = models.DataStorage.ES.ES.search(
+        index=models.DataStorage.ES_INDEX_NAME,
+        body={
+            "size": len(ds_ids),
+            "_source": ["id", "project_identifier"],
+            "query": {"bool": {"filter": {"terms": {"id": ds_ids}}}}
+        }
+    )
+    # Compare in Python rather than in the query, since the project_identifier field may be analyzed.
+    return {h["_source"]["id"] for h in result["hits"]["hits"] if h["_source"].get("project_identifier") == project_identifier}
+
 def create_srun(sreq, dxres):
     """
     Creates a SequencingRun record based on the provided DNAnexus sequencing results, to be linked
@@ -104,6 +312,14 @@ def create_srun(sreq, dxres):
     logger.debug("Creating SequencingRun record.")
     return models.SequencingRun.post(payload)
 
+@functools.lru_cache(maxsize=1)
+def _dnanexus_provider_id():
+    """
+    Returns the ID of the DNAnexus DataStorageProvider record. The record never changes, so it's
+    fetched only once per process.
+    """
+    return models.DataStorageProvider("DNAnexus").id
+
 def create_data_storage(dxres):
     """
     Creates a DataStorage record for the given DNAnexus sequencing results.
@@ -123,11 +339,16 @@ def create_data_storage(dxres):
     if exists:
         return exists
     payload["project_identifier"] = dxres.dx_project_id
-    payload["data_storage_provider_id"] = models.DataStorageProvider("DNAnexus").id
+    payload["data_storage_provider_id"] = _dnanexus_provider_id()
     # Create DataStorage
     res_json = models.DataStorage.post(payload)
     return res_json
 
+#: IDs of the SequencingRequests that check_pairedend_correct() already checked during this run,
+#: so that a SequencingRequest spanning multiple DNAnexus projects is only checked once.
+_PE_CHECKED = set()
+_PE_CHECKED_LOCK = threading.Lock()
+
 def check_pairedend_correct(sreq, dx_pe_val):
     """
     Checks whether the SequencingRequest.paired_end attribute and the 'paired' property of the
@@ -141,9 +362,68 @@ def check_pairedend_correct(sreq, dx_pe_val):
         sreq: A `pulsarpy.models.SequencingRequest` instance.
         dx_pe_val: `str`. The value of the 'paired' property of the DNAnexus project in questions.
     """
-    if sreq.paired_end == False:
-        if dx_pe_val == "true":
-            sreq.patch({"paired_end": True})
+    # Hold the lock across the check and the PATCH, so that a thread importing another project of the
+    # same SequencingRequest doesn't go on to build its payloads from the unpatched paired_end value.
+    # The SequencingRequest is only marked as checked once the PATCH succeeded, so it's retried
+    # otherwise.
+    with _PE_CHECKED_LOCK:
+        if sreq.id in _PE_CHECKED:
+            return
+        if sreq.paired_end == False:
+            if str(dx_pe_val).lower() == "true":
+                sreq.patch({"paired_end": True})
+        _PE_CHECKED.add(sreq.id)
+
+#: Cache of SequencingRequest records keyed by the normalized DNAnexus library_name property value.
+#: Several DNAnexus projects (i.e. re-runs) can map to the same SequencingRequest.
+_SREQ_CACHE = cachetools.TTLCache(maxsize=512, ttl=600)
+_SREQ_CACHE_LOCK = threading.Lock()
+#: Matches a SequencingRequest record ID, i.e. SREQ-25, capturing the primary ID.
+_SREQ_RE = re.compile(r"^SREQ-(\d+)$", re.IGNORECASE)
+#: The maximum number of SequencingResult payloads that import_dx_project() posts at once.
+POST_BATCH_SIZE = 100
+#: The number of libraries that _iter_seqresult_payloads() processes concurrently before waiting for
+#: their payloads, which bounds the number of payloads held in memory.
+LIBRARY_BATCH_SIZE = 100
+
+def lookup_sreq(lib_name_prop):
+    """
+    Finds the SequencingRequest for the given value of a DNAnexus project's library_name property.
+    See `import_dx_project()` for details on how the search is done. Results are cached, keyed by the
+    case-insensitive library name, so that the same search isn't repeated for each DNAnexus project.
+
+    Args:
+        lib_name_prop: `str`. The value of the DNAnexus project's library_name property.
+
+    Returns:
+        `pulsarpy.models.SequencingRequest` instance.
+
+    Raises:
+        `pulsarpy.elasticsearch_utils.MultipleHitsException`: Multiple SequencingRequest records were
+            found in searching by name.
+        `pulsarpy.models.RecordNotFound`: A SequencingRequest record could not be found.
+    """
+    key = lib_name_prop.strip().lower()
+    with _SREQ_CACHE_LOCK:
+        sreq = _SREQ_CACHE.get(key)
+    if sreq is not None:
+        return sreq
+    try:
+        # Using Elasticsearch here mainly in order to achieve a case-insensitive search on the
+        # SequencingRequest name field.
+        sreq = models.SequencingRequest(lib_name_prop)
+    except models.RecordNotFound: # raised in pulsarpy.models.Model.replace_name_with_id()
+        # Search by ID. The lab sometimes doesn't add a value for SequencingRequest.name and
+        # instead uses the SequencingRequest record ID, which is a concatenation of the model
+        # abbreviation, a hyphen, and the records primary ID. 
+        match = _SREQ_RE.match(lib_name_prop.strip())
+        if not match:
+            # Don't know what this DNAnexus project is form than; ignore;
+            raise
+        sreq = _get_record(models.SequencingRequest, int(match.group(1)))
+    with _SREQ_CACHE_LOCK:
+        _SREQ_CACHE[key] = sreq
+    return sreq
 
 def import_dx_project(dx_project_id):
     """
@@ -174,77 +454,382 @@ def import_dx_project(dx_project_id):
         `scgpm_seqresults_dnanexus.dnanexus_utils.FastqNotFound`: There aren't any FASTQ files in 
             the DNAnexus project for a given Library, based on the barcode specified for that Library.
     """
-    dxres = du.DxSeqResults(dx_project_id=dx_project_id)
-    logger.debug("Preparing to import DNAnexus sequencing results for {} ({}).".format(dx_project_id, dxres.dx_project_name))
-    # A pulsarpy.models.DxMissingLibraryNameProperty Exception is raised if library_name property 
-    # is not present in DNAnexus project.
-    lib_name_prop = dxres.library_name 
-    logger.debug("DNAnexus library_name property value: {}.".format(lib_name_prop))
-    #sreq = models.SequencingRequest.find_by(payload={"name": lib_name_prop})
-    # Using Elasticsearch here mainly in order to achieve a case-insensitive search on the SequencingRequest
-    # name field. 
+    dxres = get_dxres(dx_project_id)
+    props = dxres.dx_project_props
+    logger.debug("Preparing to import DNAnexus sequencing results for %s (%s).", dx_project_id, dxres.dx_project_name)
+    # A scgpm_seqresults_dnanexus.dnanexus_utils.DxMissingLibraryNameProperty Exception is raised
+    # when instantiating dxres if library_name property is not present in DNAnexus project.
+    lib_name_prop = props["library_name"]
+    logger.debug("DNAnexus library_name property value: %s.", lib_name_prop)
     logger.debug("Searching Pulsar for matching SequencingRequest record.")
     try:
         # If lib_name_prop is empty, then search below will fail with message of:
         # 'ValueError: Either the 'uid' or 'upstream' parameter must be set'. 
-        sreq = models.SequencingRequest(lib_name_prop) 
+        sreq = lookup_sreq(lib_name_prop)
     except MultipleHitsException as e: # raised in pulsarpy.models.Model.replace_name_with_id()
-        logger.error("Found multiple SequencingRequest records with name '{}'. Skipping DNAnexus project {} ({}) with library_name property set to '{}'".format(lib_name_prop, t, dxres.name))
+        logger.error("Found multiple SequencingRequest records with name '%s'. Skipping DNAnexus project %s (%s) with library_name property set to '%s'", lib_name_prop, dx_project_id, dxres.dx_project_name, lib_name_prop)
         raise
-    except models.RecordNotFound as e: # raised in pulsarpy.models.Model.replace_name_with_id()
-        # Search by ID. The lab sometimes doesn't add a value for SequencingRequest.name and
-        # instead uses the SequencingRequest record ID, which is a concatenation of the model
-        # abbreviation, a hyphen, and the records primary ID. 
-        try:
-            if not lib_name_prop.lower().startswith("sreq-"):
-                # Don't know what this DNAnexus project is form than; ignore;
-                raise models.RecordNotFound
-            else:
-                sreq = models.SequencingRequest(lib_name_prop.lower().lstrip("sreq-"))
-        except models.RecordNotFound:
-            msg = "Can't find Pulsar SequencingRequest for DNAnexus project {} ({}) with library_name property set to '{}'.".format(dx_project_id, dxres.dx_project_name, lib_name_prop)
-            logger.error(msg)
-            raise MissingSequencingRequest(msg)
-    if "paired_end" in dxres.dx_project_props:
-        check_pairedend_correct(sreq, dxres.dx_project_props["paired_end"])
-    logger.debug("Found SequencingRequest {}.".format(sreq.id))
+    except models.RecordNotFound:
+        msg = "Can't find Pulsar SequencingRequest for DNAnexus project {} ({}) with library_name property set to '{}'.".format(dx_project_id, dxres.dx_project_name, lib_name_prop)
+        logger.error(msg)
+        raise MissingSequencingRequest(msg)
+    if "paired_end" in props:
+        check_pairedend_correct(sreq, props["paired_end"])
+    logger.debug("Found SequencingRequest %s.", sreq.id)
     srun = get_or_create_srun(sreq, dxres)
-    logger.debug("SequencingRun record is: {}.".format(srun.id))
+    logger.debug("SequencingRun record is: %s.", srun.id)
     # Check if DataStorage is aleady linked to SequencingRun object. May be if user created it
     # manually in the past.
     if not srun.data_storage_id:
         ds_json = create_data_storage(dxres)
         srun.patch({"data_storage_id": ds_json["id"], "status": "finished"})
 
-    # Create SequencingResult record for each library on the SReq
-    for library_id in sreq.library_ids:
-        library = models.Library(library_id)
-        barcode = library.get_barcode_sequence()
-        if not barcode:
-            msg = "Library {} does not have a barcode set.".format(library_id)
-            logger.error(msg)
-            raise BarcodeNotSet(msg)
-        import_library(srun_id=srun.id, barcode=barcode, dxres=dxres)
+    # Look up the barcodes and FASTQ files of all libraries at once, rather than once per library.
+    lib_bcseq_hash = sreq.get_library_barcode_sequence_hash(inverse=True)
+    lib_barcodes = {library_id: barcode for barcode, library_id in lib_bcseq_hash.items() if barcode}
+    fastq_index = index_fastq_files_by_barcode(prefetch_project_files(dxres), lib_barcodes.values(), dxres.DX_FASTQ_FOLDER)
+    asm_files = prefetch_alignment_summary_metrics_files(dxres)
+    payloads = _iter_seqresult_payloads(sreq=sreq, srun=srun, dxres=dxres, lib_barcodes=lib_barcodes, fastq_index=fastq_index, asm_files=asm_files)
+    # Post the SequencingResults in batches as the payloads are built, rather than holding on to the
+    # payloads of all libraries first.
+    while True:
+        batch = list(itertools.islice(payloads, POST_BATCH_SIZE))
+        if not batch:
+            break
+        post_sequencing_results(batch)
+
+def _iter_seqresult_payloads(sreq, srun, dxres, lib_barcodes, fastq_index, asm_files):
+    """
+    Generates the SequencingResult payloads for the libraries on the given SequencingRequest that
+    don't have a SequencingResult on `srun` yet. The libraries are independent of one another, and
+    the work for each is dominated by HTTP round-trips, so they are processed concurrently,
+    `LIBRARY_BATCH_SIZE` at a time so that only a batch's worth of payloads is held in memory.
+
+    Args:
+        sreq: `pulsarpy.models.SequencingRequest` instance.
+        srun: `pulsarpy.models.SequencingRun` instance of `sreq` to import the results into.
+        dxres: `scgpm_seqresults_dnanexus.dnanexus_utils.du.DxSeqResults()` instance.
+        lib_barcodes: `dict`. The barcode sequence of each Library on `sreq`, keyed by Library ID.
+        fastq_index: `dict`. As returned by `index_fastq_files_by_barcode()`.
+        asm_files: `dict`. As returned by `prefetch_alignment_summary_metrics_files()`.
+
+    Yields:
+        `dict`. A SequencingResult payload.
+    """
+    library_ids = iter(sreq.library_ids)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        while True:
+            batch = list(itertools.islice(library_ids, LIBRARY_BATCH_SIZE))
+            if not batch:
+                break
+            futures = [executor.submit(_process_library, library_id, lib_barcodes.get(library_id), sreq, srun, dxres, fastq_index, asm_files) for library_id in batch]
+            for f in futures:
+                payload = f.result()
+                if payload:
+                    yield payload
+
+def post_sequencing_results(payloads):
+    """
+    Creates a SequencingResult record for each of the given payloads. This is the single place
+    where SequencingResult records are flushed to Pulsar during an import. The records are
+    independent of one another, so they are posted concurrently.
+
+    Args:
+        payloads: `list` of `dict`. Each is a SequencingResult payload, as returned by
+            `_build_seqresult_payload()`. import_dx_project() passes at most `POST_BATCH_SIZE` at a time.
+
+    Returns:
+        `list` of `dict`. The responses from the server containing the JSON serialization of each
+            new SequencingResult record.
+    """
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return list(executor.map(models.SequencingResult.post, payloads))
+
+def prefetch_project_files(dxres):
+    """
+    Fetches all of the FASTQ files in the given DNAnexus project, in any folder, along with their
+    properties, using a single paginated search. This replaces the per-file describe calls made by
+    `scgpm_seqresults_dnanexus.dnanexus_utils.DxSeqResults.get_fastq_files_props()`. Which of the
+    files are used for a barcode is decided by `index_fastq_files_by_barcode()`.
+
+    Args:
+        dxres: `scgpm_seqresults_dnanexus.dnanexus_utils.du.DxSeqResults()` instance.
+
+    Returns:
+        `dict`. Keys are the FASTQ file DXFile objects; values are the dict of associated properties
+        on DNAnexus on the file, plus the additional properties 'fastq_file_name' and
+        'fastq_file_folder'. This is the same structure as returned by
+        `DxSeqResults.get_fastq_files_props()`.
+    """
+    name = "*{}".format(dxres.FQEXT)
+    describe = {"fields": {"name": True, "folder": True, "properties": True}}
+    fastqs = _dx_call(list, dxpy.find_data_objects(classname="file", project=dxres.dx_project_id, name=name, name_mode="glob", describe=describe))
+    fastq_files = {}
+    for f in fastqs:
+        dxfile = dxpy.DXFile(project=f["project"], dxid=f["id"])
+        props = f["describe"]["properties"]
+        props["fastq_file_name"] = f["describe"]["name"]
+        props["fastq_file_folder"] = f["describe"]["folder"]
+        fastq_files[dxfile] = props
+    return fastq_files
+
+def index_fastq_files_by_barcode(fastq_files, barcodes, fastq_folder):
+    """
+    Groups the FASTQ files of a DNAnexus project by barcode in a single pass over the files, so that
+    finding the FASTQ files of a given Library is a dict lookup rather than a scan of all files.
+
+    A FASTQ file belongs to a barcode if the barcode is one of the underscore-delimited fields of
+    its name, other than the first and last (i.e. the same files matched by the
+    "*_${barcode}_*.fastq.gz" glob used by `DxSeqResults.get_fastq_dxfile_objects()`). Like that
+    method, the files of a barcode that are in `fastq_folder` (or any of its subfolders) are
+    preferred; only if there aren't any there are the barcode's files in other folders used.
+
+    Args:
+        fastq_files: `dict`. The FASTQ files of a DNAnexus project, as returned by `prefetch_project_files()`.
+        barcodes: iterable of `str`. The barcode sequences to index the files by.
+        fastq_folder: `str`. The folder that normally holds the FASTQ files, i.e.
+            `DxSeqResults.DX_FASTQ_FOLDER`.
+
+    Returns:
+        `dict`. Keys are barcode sequences; values are the subset of `fastq_files` for that barcode.
+    """
+    barcodes = set(barcodes)
+    fastq_folder = fastq_folder.rstrip("/")
+    in_folder = {}
+    elsewhere = {}
+    for dxfile, props in fastq_files.items():
+        folder = props["fastq_file_folder"]
+        if folder == fastq_folder or folder.startswith(fastq_folder + "/"):
+            index = in_folder
+        else:
+            index = elsewhere
+        for field in props["fastq_file_name"].split("_")[1:-1]:
+            if field in barcodes:
+                index.setdefault(field, {})[dxfile] = props
+    fastq_index = {}
+    for barcode in in_folder.keys() | elsewhere.keys():
+        fastq_index[barcode] = in_folder.get(barcode) or elsewhere[barcode]
+    return fastq_index
+
+def get_barcode_fastq_files(fastq_index, barcode):
+    """
+    Returns the FASTQ files for the given barcode.
+
+    Args:
+        fastq_index: `dict`. As returned by `index_fastq_files_by_barcode()`.
+        barcode: `str`. The barcode sequence of a Library.
+
+    Returns:
+        `dict`. Keys are the FASTQ file DXFile objects; values are the dict of associated properties.
+
+    Raises:
+        `scgpm_seqresults_dnanexus.dnanexus_utils.FastqNotFound`: No FASTQ files were found for the barcode.
+    """
+    barcode_files = fastq_index.get(barcode)
+    if not barcode_files:
+        raise du.FastqNotFound("No FASTQ files found for barcode {}.".format(barcode))
+    return barcode_files
+
+def prefetch_alignment_summary_metrics_files(dxres):
+    """
+    Finds all of the Picard alignment summary metrics files (named ${barcode}.alignment_summary_metrics)
+    in the given DNAnexus project using a single search, rather than one search per barcode as done by
+    `scgpm_seqresults_dnanexus.dnanexus_utils.DxSeqResults.get_alignment_summary_metrics()`.
+
+    Args:
+        dxres: `scgpm_seqresults_dnanexus.dnanexus_utils.du.DxSeqResults()` instance.
+
+    Returns:
+        `dict`. Keys are barcode sequences; values are the DNAnexus file IDs of the alignment
+        summary metrics files.
+    """
+    ext = ".alignment_summary_metrics"
+    hits = _dx_call(list, dxpy.find_data_objects(classname="file", project=dxres.dx_project_id, name="*" + ext, name_mode="glob", describe={"fields": {"name": True}}))
+    return {h["describe"]["name"][:-len(ext)]: h["id"] for h in hits}
+
+def get_alignment_summary_metrics(asm_files, barcode, dxres):
+    """
+    Downloads and parses the Picard alignment summary metrics file for the given barcode.
+
+    Args:
+        asm_files: `dict`. As returned by `prefetch_alignment_summary_metrics_files()`.
+        barcode: `str`. The barcode sequence of a Library.
+        dxres: `scgpm_seqresults_dnanexus.dnanexus_utils.du.DxSeqResults()` instance.
+
+    Returns:
+        `dict`. The same as returned by `DxSeqResults.get_alignment_summary_metrics()`.
+
+    Raises:
+        `scgpm_seqresults_dnanexus.dnanexus_utils.DxMissingAlignmentSummaryMetrics`: There isn't an
+            alignment summary metrics file for the barcode.
+    """
+    file_id = asm_files.get(barcode)
+    if not file_id:
+        msg = "Picard alignment summary metrics for barcode {} in DX project {} not found.".format(barcode, dxres.dx_project_id)
+        raise du.DxMissingAlignmentSummaryMetrics(msg)
+    fh = StringIO(_dx_call(lambda: dxpy.open_dxfile(file_id, project=dxres.dx_project_id).read()))
+    return picard.CollectAlignmentSummaryMetrics(fh).metrics
+
+def _process_library(library_id, barcode, sreq, srun, dxres, fastq_index=None, asm_files=None):
+    """
+    Builds the SequencingResult payload for a single Library on the given SequencingRequest.
+
+    Args:
+        library_id: `int`. The ID of a Library record on `sreq`.
+        barcode: `str`. The barcode sequence of the Library, or `None` if it doesn't have one set.
+        sreq: `pulsarpy.models.SequencingRequest` instance.
+        srun: `pulsarpy.models.SequencingRun` instance of `sreq` to import the results into.
+        dxres: `scgpm_seqresults_dnanexus.dnanexus_utils.du.DxSeqResults()` instance.
+        fastq_index: `dict`. The FASTQ files of the DNAnexus project, as returned by
+            `index_fastq_files_by_barcode()`. If not set, the FASTQ files are looked up for the
+            Library's barcode only.
+        asm_files: `dict`. The alignment summary metrics files of the DNAnexus project, as returned
+            by `prefetch_alignment_summary_metrics_files()`. If not set, the file is looked up for the
+            Library's barcode only.
+
+    Returns:
+        `dict`. The SequencingResult payload, or `None` if the Library already has a SequencingResult
+            on `srun`.
+
+    Raises:
+        `BarcodeNotSet`: The Library does not have a barcode set.
+    """
+    if not barcode:
+        msg = "Library {} does not have a barcode set.".format(library_id)
+        logger.error(msg)
+        raise BarcodeNotSet(msg)
+    return _build_seqresult_payload(library_id=library_id, barcode=barcode, sreq=sreq, srun=srun, dxres=dxres, fastq_index=fastq_index, asm_files=asm_files)
 
 
 def import_library(srun_id, barcode, dxres):
-    srun = models.SequencingRun(srun_id)
-    sreq = models.SequencingRequest(srun.sequencing_request_id)
+    srun = _get_record(models.SequencingRun, srun_id)
+    sreq = _get_record(models.SequencingRequest, srun.sequencing_request_id)
     lib_bcseq_hash = sreq.get_library_barcode_sequence_hash(inverse=True)
     library_id = lib_bcseq_hash[barcode]
-    library = models.Library(library_id)
-    # Check if SequencingResult record for given library already exists.
-    if library_id in srun.library_sequencing_results():
+    payload = _build_seqresult_payload(library_id=library_id, barcode=barcode, sreq=sreq, srun=srun, dxres=dxres)
+    if payload:
+        post_sequencing_results([payload])
+
+#: The SequencingResult attributes that hold the values for each read number.
+READ_URI_KEY = {1: "read1_uri", 2: "read2_uri"}
+READ_COUNT_KEY = {1: "read1_count", 2: "read2_count"}
+READ_ALIGNED_PERC_KEY = {1: "read1_aligned_perc", 2: "read2_aligned_perc"}
+#: The category of Picard's alignment summary metrics that holds the metrics for each read number.
+ASM_READ_CATEGORY = {1: "FIRST_OF_PAIR", 2: "SECOND_OF_PAIR"}
+
+def _to_number(val):
+    """
+    Converts a metric value from Picard's text output to an `int` or `float`. Values that aren't
+    numeric, i.e. blank ones, are returned as is.
+    """
+    try:
+        return int(val)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return val
+
+def convert_metric_values(asm):
+    """
+    Converts the values of Picard's alignment summary metrics from strings to numbers, once for
+    the barcode, so that the code building the payloads can use them directly.
+
+    Args:
+        asm: `dict`. Picard's alignment summary metrics, keyed by category, as returned by
+            `get_alignment_summary_metrics()`.
+
+    Returns:
+        `dict`. The same categories and metrics, with numeric values.
+    """
+    return {category: {name: _to_number(val) for name, val in metrics.items()} for category, metrics in asm.items()}
+
+def get_read_num(props):
+    """
+    Determines the read number of a FASTQ file, either from its 'read' property on DNAnexus, or
+    otherwise from its file name.
+
+    Args:
+        props: `dict`. The properties of the FASTQ file on DNAnexus, including the additional
+            'fastq_file_name' property.
+
+    Returns:
+        `int`. 1 or 2.
+    """
+    read_num = props.get("read", None)
+    if read_num:
+        read_num = int(read_num)
+    else:
+        fastq_file_name = props["fastq_file_name"]
+        if "_R1" in fastq_file_name:
+            read_num = 1
+        elif "_R2" in fastq_file_name:
+            read_num = 2
+    if not read_num in [1, 2]:
+        raise Exception("Unknown read number '{}'. Should be either 1 or 2.".format(read_num))
+    return read_num
+
+def build_read_payload(read_num, file_id, asm):
+    """
+    Builds the read-specific part of a SequencingResult payload.
+
+    Args:
+        read_num: `int`. The read number (1 or 2).
+        file_id: `str`. The DNAnexus file ID of the FASTQ file for the read.
+        asm: `dict`. Picard's alignment summary metrics for the barcode, with numeric values as
+            returned by `convert_metric_values()`, or `None` if there aren't any.
+
+    Returns:
+        `dict`.
+    """
+    read_payload = {READ_URI_KEY[read_num]: file_id}
+    if asm:
+        metrics = asm[ASM_READ_CATEGORY[read_num]]
+        read_payload[READ_COUNT_KEY[read_num]] = metrics["PF_READS"]
+        read_payload[READ_ALIGNED_PERC_KEY[read_num]] = round(metrics["PCT_PF_READS_ALIGNED"] * 100, 2)
+    return read_payload
+
+def _build_seqresult_payload(library_id, barcode, sreq, srun, dxres, fastq_index=None, asm_files=None):
+    """
+    Builds the payload for a SequencingResult record on the given SequencingRun for the given
+    Library. The records are passed in so that they aren't re-fetched for each Library.
+
+    Returns:
+        `dict`. The SequencingResult payload, or `None` if the Library already has a SequencingResult
+            on `srun`.
+    """
+    # Check if SequencingResult record for given library already exists. A single find_by query,
+    # rather than srun.library_sequencing_results() which fetches every SequencingResult on the
+    # SequencingRun one at a time.
+    if models.SequencingResult.find_by(payload={"sequencing_run_id": srun.id, "library_id": library_id}):
         return
     payload = {}
     payload["mapper"] = "bwa"
     payload["sequencing_run_id"] = srun.id
     payload["library_id"] = library_id
     # Find the barcode file on DNAnexus
-    logger.debug("Processing Library {} ({}) with barcode {}.".format(library.name, library_id, barcode))
+    logger.debug("Processing Library %s with barcode %s.", library_id, barcode)
+    #### Get Picard's Alignment summary metrics
+    def fetch_asm():
+        logger.debug("Download alignment summary metrics for barcode %s.", barcode)
+        if asm_files is None:
+            return _dx_call(dxres.get_alignment_summary_metrics, barcode=barcode)
+        return get_alignment_summary_metrics(asm_files, barcode, dxres)
+
+    logger.debug("Locating sequencing files for Library %s, barcode %s.", library_id, barcode)
+    asm_future = None
     try:
-        logger.debug("Locating sequencing files for Library {}, barcode {}.".format(library_id, barcode))
-        barcode_files = dxres.get_fastq_files_props(barcode=barcode)
+        if fastq_index is None:
+            # The FASTQ file lookup and the alignment summary metrics download both hit DNAnexus and
+            # don't depend on each other, so fetch them concurrently.
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                fastq_future = executor.submit(_dx_call, dxres.get_fastq_files_props, barcode=barcode)
+                asm_future = executor.submit(fetch_asm)
+            barcode_files = fastq_future.result()
+        else:
+            # No API call needed; just look up the FASTQ files that were prefetched for the project.
+            barcode_files = get_barcode_fastq_files(fastq_index, barcode)
     except du.FastqNotFound as e:
         logger.error(e.args)
         raise 
@@ -255,46 +840,20 @@ def import_library(srun_id, barcode, dxres):
 
     # Read barcode_stats.json to get mapped read counts for the given barcode:
     #barcode_stats = dxres.get_barcode_stats_json(barcode=barcode)
-    
-    logger.debug("Download alignment summary metrics for barcode {}.".format(barcode))
 
-    #### Get Picard's Alignment summary metrics
     # dxres.get_alignment_summary_metrics() raises a scgpm_seqresults_dnanexus.dnanexus_utils.DxMissingAlignmentSummaryMetrics 
     # exception if a Picard alignment summary metrics file couldn't be found.
     try:
-        asm = dxres.get_alignment_summary_metrics(barcode=barcode)
+        asm = convert_metric_values(asm_future.result() if asm_future else fetch_asm())
     except du.DxMissingAlignmentSummaryMetrics:
         # GSSC doesn't do any analysis for NovaSeq runs. 
         asm = None
+    # The pair-level metric is the same for both reads, so it's set once for the library.
+    paired = bool(sreq.paired_end)
+    if asm and paired:
+        payload["pair_aligned_perc"] = round(asm["PAIR"]["PCT_READS_ALIGNED_IN_PAIRS"] * 100, 2)
     for dxfile in barcode_files:
-        file_id = dxfile.id
-        props = barcode_files[dxfile]
-        read_num = props.get("read", None)
-        if read_num:
-            read_num = int(read_num)
-        else:
-            fastq_file_name = props["fastq_file_name"]
-            if "_R1" in fastq_file_name:
-                read_num = 1
-            elif "_R2" in fastq_file_name:
-                read_num = 2
-        if not read_num in [1, 2]:
-            raise Exception("Unknown read number '{}'. Should be either 1 or 2.".format(read_num))
-        if read_num == 1:
-            payload["read1_uri"] = file_id
-        else:
-            payload["read2_uri"] = file_id
-    
-    if asm:
-        if sreq.paired_end:
-            payload["pair_aligned_perc"] = round(float(asm["PAIR"]["PCT_READS_ALIGNED_IN_PAIRS"]) * 100, 2)
-        if read_num == 1:
-            metrics = asm["FIRST_OF_PAIR"]
-            payload["read1_count"] = metrics["PF_READS"]
-            payload["read1_aligned_perc"] = round(float(metrics["PCT_PF_READS_ALIGNED"]) * 100, 2)
-        else:
-            metrics = asm["SECOND_OF_PAIR"]
-            payload["read2_count"] = metrics["PF_READS"]
-            payload["read2_aligned_perc"] = round(float(metrics["PCT_PF_READS_ALIGNED"]) * 100, 2)
-    models.SequencingResult.post(payload)
+        read_num = get_read_num(barcode_files[dxfile])
+        payload.update(build_read_payload(read_num=read_num, file_id=dxfile.id, asm=asm))
+    return payload
 
@@ -36,6 +36,7 @@ setup(
   description = "A client for Pulsar LIMS that integrates sequencing results from DNAnexus",
   install_requires = [
     "boto3",
+    "cachetools",
     "dxpy3",
     "pulsarpy",
     "requests",